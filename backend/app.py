@@ -1,27 +1,62 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify, g, url_for, send_from_directory
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
 from flask_talisman import Talisman
-from colorthief import ColorThief
+from PIL import Image
+from scipy.cluster.vq import kmeans2
+import numpy as np
 import os
-import json
+import orjson
+import sqlite3
 import bcrypt
 import jwt
 import secrets
 import re
 import html
+import hashlib
+import base64
+import binascii
+import io
+import warnings
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from functools import wraps
-from urllib.parse import quote
+from urllib.parse import quote, urlparse
+
+class OrjsonProvider(JSONProvider):
+    """使用 orjson 进行 JSON 编解码（jsonify 和 request.json 均经过此处）"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode('utf-8')
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        # 直接使用 orjson 输出的 bytes，省去一次解码/编码
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj), mimetype="application/json")
 
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 # 安全配置
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', secrets.token_urlsafe(32))
 app.config['JWT_SECRET_KEY'] = os.environ.get('JWT_SECRET_KEY', secrets.token_urlsafe(32))
 app.config['JWT_ACCESS_TOKEN_EXPIRES'] = timedelta(hours=24)
 app.config['JWT_REFRESH_TOKEN_EXPIRES'] = timedelta(days=30)
+# bcrypt 轮数（已有哈希中自带轮数，修改后不影响旧密码验证）
+app.config['BCRYPT_ROUNDS'] = int(os.environ.get('BCRYPT_ROUNDS', 10))
+# 是否保留上传的图片（默认只在内存中提取主色，不落盘）
+app.config['KEEP_UPLOADS'] = os.environ.get('KEEP_UPLOADS', '').lower() in ('1', 'true', 'yes')
+# 每个进程的主色提取子进程数（多 worker 部署时按 worker 数分摊 CPU）
+app.config['COLOR_POOL_WORKERS'] = int(os.environ.get('COLOR_POOL_WORKERS', os.cpu_count() or 1))
 
 # 安全头配置
 Talisman(app, 
@@ -43,55 +78,420 @@ CORS(app,
     supports_credentials=True
 )
 
-# 速率限制
+# 速率限制（多进程部署时需使用 Redis 等共享存储，否则每个 worker 各自计数）
 limiter = Limiter(
     app=app,
     key_func=get_remote_address,
     default_limits=["200 per day", "50 per hour"],
-    storage_uri="memory://"
+    storage_uri=os.environ.get('RATELIMIT_STORAGE_URI', 'memory://'),
+    strategy="moving-window",
+    in_memory_fallback_enabled=True  # Redis 不可用时临时退回进程内计数
 )
 
 UPLOAD_FOLDER = "uploads"
+AVATAR_FOLDER = os.path.join(UPLOAD_FOLDER, "avatars")
 USERS_FOLDER = "users"
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+os.makedirs(AVATAR_FOLDER, exist_ok=True)
 os.makedirs(USERS_FOLDER, exist_ok=True)
 
-# 简单的用户数据存储（实际应该使用数据库）
+# 用户数据存储（SQLite，按行读写）
+USERS_DB = os.path.join(USERS_FOLDER, "users.db")
+# 旧版 JSON 用户文件，数据库为空时导入一次
 USERS_FILE = os.path.join(USERS_FOLDER, "users.json")
 
 # CSRF Token 存储（生产环境应使用 Redis）
 csrf_tokens = {}
 
-def load_users():
-    """加载用户数据"""
-    if os.path.exists(USERS_FILE):
-        with open(USERS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {}
-
-def save_users(users):
-    """保存用户数据"""
-    # 原子性写入：先写入临时文件，再重命名
-    temp_file = USERS_FILE + '.tmp'
-    with open(temp_file, 'w', encoding='utf-8') as f:
-        json.dump(users, f, ensure_ascii=False, indent=2)
-    os.replace(temp_file, USERS_FILE)
+# 每个进程共享一个连接，所有语句在锁内执行，避免线程间事务交错
+_db = None
+_db_pid = None
+_db_lock = threading.RLock()
+
+# 连续登录失败达到上限后锁定账户一段时间
+LOGIN_MAX_FAILURES = 5
+LOGIN_LOCK_DURATION = timedelta(minutes=15)
+
+def get_db():
+    """获取当前进程的数据库连接（首次使用时建表）"""
+    global _db, _db_pid
+    # fork 出的子进程不能复用父进程的连接
+    if _db is None or _db_pid != os.getpid():
+        with _db_lock:
+            if _db is None or _db_pid != os.getpid():
+                # 其他 worker 首次导入时持有写锁，留足等待时间
+                conn = sqlite3.connect(USERS_DB, timeout=30, check_same_thread=False)
+                conn.row_factory = sqlite3.Row
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+                init_db(conn)
+                _db, _db_pid = conn, os.getpid()
+    return _db
+
+def init_db(conn):
+    """建表，在数据库为空时导入旧版 users.json，并把内联头像迁移为文件
+
+    旧数据中存在重名用户，因此用户名唯一性仍由注册/更新时的检查保证，不加唯一约束。
+    多个 worker 可能同时首次打开数据库，整个过程在 BEGIN IMMEDIATE 写锁内执行，
+    后拿到锁的进程会看到已导入的数据，不会重复导入或重复迁移头像。
+    """
+    saved_avatars = []
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY,
+                email TEXT UNIQUE NOT NULL,
+                username TEXT NOT NULL,
+                password TEXT NOT NULL,
+                gender TEXT,
+                avatar TEXT,
+                created_at TEXT,
+                updated_at TEXT,
+                failed_login_attempts INTEGER NOT NULL DEFAULT 0,
+                locked_until TEXT,
+                last_login TEXT
+            )
+        """)
+        # 用户名查重不区分大小写，使用 NOCASE 索引避免全表扫描
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)"
+        )
+        if (not conn.execute("SELECT 1 FROM users LIMIT 1").fetchone()
+                and os.path.exists(USERS_FILE)):
+            _import_legacy_users(conn)
+        _migrate_inline_avatars(conn, saved_avatars)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        # 事务回滚后，迁移过程中写出的头像文件不再被引用
+        for filename in saved_avatars:
+            delete_avatar(filename)
+        raise
+
+def _import_legacy_users(conn):
+    """导入旧版 users.json"""
+    with open(USERS_FILE, 'rb') as f:
+        legacy_users = orjson.loads(f.read())
+    conn.executemany(
+        """INSERT INTO users (id, email, username, password, gender, avatar,
+                              created_at, updated_at, failed_login_attempts,
+                              locked_until, last_login)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        [
+            (int(u["id"]), email, u.get("username", ""), u.get("password", ""),
+             u.get("gender"), u.get("avatar"), u.get("createdAt"), u.get("updatedAt"),
+             u.get("failed_login_attempts", 0), u.get("locked_until"), u.get("last_login"))
+            for email, u in legacy_users.items()
+        ]
+    )
+
+def _migrate_inline_avatars(conn, saved_avatars):
+    """把以 base64 data URL 存在数据库中的头像转存为文件（无法解析的保持原样）
+
+    写出的文件名追加到 saved_avatars，供事务回滚时清理。
+    """
+    rows = conn.execute("SELECT id, avatar FROM users WHERE avatar LIKE 'data:%'").fetchall()
+    for row in rows:
+        decoded = decode_avatar(row["avatar"])
+        if decoded:
+            filename = save_avatar(*decoded)
+            saved_avatars.append(filename)
+            conn.execute("UPDATE users SET avatar = ? WHERE id = ?", (filename, row["id"]))
+
+def _row_to_user(row):
+    """数据库行转换为用户字典（字段与原 JSON 结构保持一致）"""
+    if row is None:
+        return None
+    user = {
+        "id": str(row["id"]),
+        "username": row["username"],
+        "email": row["email"],
+        "password": row["password"],
+        "gender": row["gender"],
+        "avatar": row["avatar"],
+        "createdAt": row["created_at"],
+        "updatedAt": row["updated_at"],
+        "failed_login_attempts": row["failed_login_attempts"],
+        "locked_until": row["locked_until"],
+        "last_login": row["last_login"]
+    }
+    return user
+
+# 可返回给客户端的用户字段（白名单，密码和登录失败记录等内部字段不会外泄）
+_USER_PUBLIC_KEYS = ('id', 'username', 'email', 'gender', 'avatar', 'createdAt', 'updatedAt', 'last_login')
+
+def public_user(user):
+    """构造返回给客户端的用户信息"""
+    response = {k: user.get(k) for k in _USER_PUBLIC_KEYS}
+    response["avatar"] = avatar_url(user.get("avatar"))
+    return response
+
+# 头像以文件形式保存在 AVATAR_FOLDER，数据库中只记录文件名
+AVATAR_MAX_BYTES = 2 * 1024 * 1024  # 2MB限制（解码后的图片大小）
+# base64 编码后的长度上限（留出 data URL 头部的余量），超过时无需解码即可拒绝
+AVATAR_MAX_ENCODED_LENGTH = (AVATAR_MAX_BYTES + 2) // 3 * 4 + 64
+_AVATAR_TYPES = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/gif': '.gif',
+    'image/webp': '.webp'
+}
+
+def avatar_url(avatar):
+    """头像字段转换为客户端可访问的地址（旧数据中的 data URL 原样返回）"""
+    if not avatar or avatar.startswith('data:'):
+        return avatar
+    return url_for('get_avatar', filename=avatar, _external=True)
+
+def is_current_avatar(avatar, current):
+    """判断客户端传回的头像是否就是当前头像（按文件名比较，与请求的域名无关）"""
+    if not current:
+        return False
+    if avatar == current:
+        return True
+    if avatar.startswith('data:') or current.startswith('data:'):
+        return False
+    return os.path.basename(urlparse(avatar).path) == current
+
+def decode_avatar(avatar):
+    """解析 base64 data URL 头像，返回 (图片内容, 扩展名)；格式无效时返回 None"""
+    header, sep, encoded = avatar.partition(',')
+    if not sep or not header.startswith('data:') or not header.endswith(';base64'):
+        return None
+    ext = _AVATAR_TYPES.get(header[len('data:'):-len(';base64')].lower())
+    if not ext:
+        return None
+    try:
+        return base64.b64decode(encoded, validate=True), ext
+    except (binascii.Error, ValueError):
+        return None
+
+def save_avatar(content, ext):
+    """保存头像文件，返回文件名（随机命名，更换头像后地址随之变化）"""
+    filename = f"{secrets.token_urlsafe(16)}{ext}"
+    with open(os.path.join(AVATAR_FOLDER, filename), 'wb') as f:
+        f.write(content)
+    return filename
+
+def delete_avatar(avatar):
+    """删除头像文件（旧数据中的 data URL 无需处理）"""
+    if not avatar or avatar.startswith('data:'):
+        return
+    try:
+        os.remove(os.path.join(AVATAR_FOLDER, os.path.basename(avatar)))
+    except FileNotFoundError:
+        pass
+
+def get_user_by_email(email):
+    """按邮箱查询用户"""
+    with _db_lock:
+        row = get_db().execute("SELECT * FROM users WHERE email = ?", (email,)).fetchone()
+        return _row_to_user(row)
+
+def get_user_by_id(user_id):
+    """按 ID 查询用户"""
+    with _db_lock:
+        row = get_db().execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        return _row_to_user(row)
+
+def username_exists(username, exclude_id=None):
+    """检查用户名是否已被使用（不区分大小写）"""
+    with _db_lock:
+        row = get_db().execute(
+            "SELECT 1 FROM users WHERE username = ? COLLATE NOCASE AND id IS NOT ?",
+            (username, exclude_id)
+        ).fetchone()
+    return row is not None
+
+def create_user(user):
+    """插入新用户，返回分配的用户 ID"""
+    conn = get_db()
+    with _db_lock, conn:
+        cursor = conn.execute(
+            """INSERT INTO users (email, username, password, gender, avatar,
+                                  created_at, updated_at, failed_login_attempts, locked_until)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (user["email"], user["username"], user["password"], user["gender"], user["avatar"],
+             user["createdAt"], user["updatedAt"], user["failed_login_attempts"], user["locked_until"])
+        )
+    return str(cursor.lastrowid)
+
+def update_user_record(user_id, fields):
+    """更新单个用户的指定列（fields 的键必须是数据库列名）"""
+    assignments = ", ".join(f"{column} = ?" for column in fields)
+    conn = get_db()
+    with _db_lock, conn:
+        conn.execute(
+            f"UPDATE users SET {assignments} WHERE id = ?",
+            (*fields.values(), user_id)
+        )
+
+def record_login_failure(email, now):
+    """登录失败：累加失败次数，达到上限时锁定账户并清零计数
+
+    单条 UPDATE 在数据库中完成判断（右侧表达式均取更新前的值），
+    多个 worker 进程并发失败时不会互相覆盖。
+    """
+    conn = get_db()
+    with _db_lock, conn:
+        conn.execute(
+            """UPDATE users SET
+                   locked_until = CASE WHEN failed_login_attempts + 1 >= ?
+                                       THEN ? ELSE locked_until END,
+                   failed_login_attempts = CASE WHEN failed_login_attempts + 1 >= ?
+                                                THEN 0 ELSE failed_login_attempts + 1 END
+               WHERE email = ?""",
+            (LOGIN_MAX_FAILURES, (now + LOGIN_LOCK_DURATION).isoformat(), LOGIN_MAX_FAILURES, email)
+        )
+
+def record_login_success(email, last_login, password_hash=None):
+    """登录成功：重置失败次数并记录登录时间（给出 password_hash 时一并替换密码哈希）"""
+    conn = get_db()
+    with _db_lock, conn:
+        conn.execute(
+            "UPDATE users SET failed_login_attempts = 0, locked_until = NULL, last_login = ?, "
+            "password = COALESCE(?, password) WHERE email = ?",
+            (last_login, password_hash, email)
+        )
+
+# bcrypt 计算线程池：哈希期间释放 GIL，并发登录/注册可并行，且总并发不超过 CPU 数
+# （按进程延迟创建，fork 后不复用）
+_bcrypt_pool = None
+_bcrypt_pool_pid = None
+_bcrypt_pool_lock = threading.Lock()
+
+def _new_native_thread_pool(max_workers, thread_name_prefix):
+    """创建系统线程池
+
+    gevent 打补丁后 threading 线程实际是协程，CPU 计算会阻塞整个事件循环，
+    此时改用 gevent 提供的系统线程池（等待结果时仍可切换协程）。
+    """
+    try:
+        from gevent import monkey
+        if monkey.is_module_patched('threading'):
+            from gevent.threadpool import ThreadPoolExecutor as GeventThreadPoolExecutor
+            return GeventThreadPoolExecutor(max_workers=max_workers)
+    except ImportError:
+        pass
+    return ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+
+def _run_bcrypt(func, *args):
+    """在 bcrypt 线程池中执行并等待结果"""
+    global _bcrypt_pool, _bcrypt_pool_pid
+    with _bcrypt_pool_lock:
+        if _bcrypt_pool is None or _bcrypt_pool_pid != os.getpid():
+            _bcrypt_pool = _new_native_thread_pool(os.cpu_count(), "bcrypt")
+            _bcrypt_pool_pid = os.getpid()
+        pool = _bcrypt_pool
+    return pool.submit(func, *args).result()
 
 def hash_password(password):
     """使用 bcrypt 进行安全的密码哈希（加盐）"""
     # bcrypt 自动生成盐并包含在哈希中
-    salt = bcrypt.gensalt(rounds=12)  # 12轮，平衡安全性和性能
-    return bcrypt.hashpw(password.encode('utf-8'), salt).decode('utf-8')
+    salt = bcrypt.gensalt(rounds=app.config['BCRYPT_ROUNDS'])
+    hashed = _run_bcrypt(bcrypt.hashpw, password.encode('utf-8'), salt)
+    return hashed.decode('utf-8')
 
 def verify_password(password, hashed):
     """验证密码（常量时间比较，防止时序攻击）"""
     try:
-        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+        return _run_bcrypt(bcrypt.checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
     except Exception:
         # 即使出错也执行常量时间操作，防止时序攻击
-        bcrypt.checkpw(b'dummy', b'$2b$12$dummy')
+        _run_bcrypt(bcrypt.checkpw, b'dummy', _DUMMY_HASH)
         return False
 
+def password_needs_rehash(hashed):
+    """已存储哈希的轮数与当前配置不一致时返回 True"""
+    try:
+        return int(hashed.split('$')[2]) != app.config['BCRYPT_ROUNDS']
+    except (IndexError, ValueError):
+        return True
+
+# 用户不存在时用于假验证的哈希（启动时生成一次，轮数与真实哈希一致，耗时相同；
+# 旧哈希在登录成功后按当前轮数重新生成，见 login）
+_DUMMY_HASH = bcrypt.hashpw(b'x', bcrypt.gensalt(rounds=app.config['BCRYPT_ROUNDS']))
+
+def dummy_verify_password(password):
+    """对不存在的用户执行一次等耗时的假验证（结果总是 False）"""
+    _run_bcrypt(bcrypt.checkpw, password.encode('utf-8'), _DUMMY_HASH)
+    return False
+
+# 主色提取进程池：图片解码和聚类都是 CPU 密集操作，
+# 放到独立进程中才能让并发上传真正并行（按进程延迟创建，fork 后不复用）
+_color_pool = None
+_color_pool_pid = None
+_color_pool_lock = threading.Lock()
+
+# 主色提取参数：缩略图尺寸和聚类数
+COLOR_THUMBNAIL_SIZE = (200, 200)
+COLOR_CLUSTERS = 5
+
+def _extract_color(data):
+    """提取图片主色：在缩略图上做 k-means，返回像素最多的簇中心（在子进程中执行）"""
+    with Image.open(io.BytesIO(data)) as img:
+        img.thumbnail(COLOR_THUMBNAIL_SIZE)
+        pixels = np.asarray(img.convert('RGBA'), dtype=np.uint8).reshape(-1, 4)
+    
+    # 与 ColorThief 一致：忽略透明和接近纯白的像素
+    mask = (pixels[:, 3] >= 125) & ~np.all(pixels[:, :3] > 250, axis=1)
+    rgb = pixels[mask, :3] if mask.any() else pixels[:, :3]
+    
+    # 颜色种类不超过聚类数时直接取出现最多的颜色（k-means 初始化在此情况下会退化）
+    packed = (rgb[:, 0].astype(np.uint32) << 16) | (rgb[:, 1].astype(np.uint32) << 8) | rgb[:, 2]
+    colors, counts = np.unique(packed, return_counts=True)
+    if len(colors) <= COLOR_CLUSTERS:
+        top = int(colors[counts.argmax()])
+        return (top >> 16, (top >> 8) & 0xFF, top & 0xFF)
+    
+    with warnings.catch_warnings():
+        # 迭代中出现空簇不影响结果（只取最大簇）
+        warnings.simplefilter("ignore", UserWarning)
+        centers, labels = kmeans2(
+            rgb.astype(np.float32), COLOR_CLUSTERS, iter=20, minit='++', seed=0
+        )
+    dominant = centers[np.bincount(labels, minlength=COLOR_CLUSTERS).argmax()]
+    return tuple(int(round(float(x))) for x in dominant)
+
+def extract_dominant_color(data):
+    """在进程池中提取图片主色（data 为图片文件内容）"""
+    global _color_pool, _color_pool_pid
+    with _color_pool_lock:
+        if _color_pool is None or _color_pool_pid != os.getpid():
+            _color_pool = ProcessPoolExecutor(max_workers=app.config['COLOR_POOL_WORKERS'])
+            _color_pool_pid = os.getpid()
+        pool = _color_pool
+    try:
+        return pool.submit(_extract_color, data).result()
+    except BrokenProcessPool:
+        # 子进程异常退出后进程池不可再用，下次请求重建
+        with _color_pool_lock:
+            if _color_pool is pool:
+                _color_pool = None
+        raise
+
+# 主色结果缓存：按上传内容哈希记忆，重复上传同一图片时跳过落盘和提取
+COLOR_CACHE_SIZE = 1024
+_color_cache = OrderedDict()
+_color_cache_lock = threading.Lock()
+
+def get_cached_color(key):
+    """读取缓存的主色（命中时刷新 LRU 顺序）"""
+    with _color_cache_lock:
+        color = _color_cache.get(key)
+        if color is not None:
+            _color_cache.move_to_end(key)
+        return color
+
+def cache_color(key, color):
+    """写入主色缓存，超出容量时淘汰最久未使用的条目"""
+    with _color_cache_lock:
+        _color_cache[key] = color
+        _color_cache.move_to_end(key)
+        if len(_color_cache) > COLOR_CACHE_SIZE:
+            _color_cache.popitem(last=False)
+
 def generate_csrf_token():
     """生成 CSRF Token"""
     token = secrets.token_urlsafe(32)
@@ -104,13 +504,24 @@ def validate_csrf_token(token):
     # 简单的内存存储验证（生产环境应使用 Redis 或数据库）
     return token in csrf_tokens.values()
 
+# 输入校验用正则（模块加载时预编译）
+_CTRL_RE = re.compile(r'[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]')
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+_USERNAME_RE = re.compile(r'^[a-zA-Z0-9_-]+$')
+_PASSWORD_LETTER_RE = re.compile(r'[A-Za-z]')
+_PASSWORD_DIGIT_RE = re.compile(r'[0-9]')
+
+# 危险字符集合：isdisjoint 在 C 层单次遍历字符串
+_EMAIL_DANGEROUS = frozenset('<>"\'&\x00')
+_USERNAME_DANGEROUS = frozenset('<>"\'&\x00;|`')
+
 def sanitize_input(text, max_length=None):
     """清理和验证用户输入，防止 XSS 和注入攻击"""
     if not isinstance(text, str):
         return ""
     
     # 移除控制字符（除了换行和制表符）
-    text = re.sub(r'[\x00-\x08\x0B-\x0C\x0E-\x1F\x7F]', '', text)
+    text = _CTRL_RE.sub('', text)
     
     # HTML 转义
     text = html.escape(text)
@@ -131,13 +542,11 @@ def validate_email(email):
         return False
     
     # 严格的邮箱格式验证
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    if not re.match(pattern, email):
+    if not _EMAIL_RE.match(email):
         return False
     
     # 防止注入攻击：检查危险字符
-    dangerous_chars = ['<', '>', '"', "'", '&', '\x00']
-    if any(char in email for char in dangerous_chars):
+    if not _EMAIL_DANGEROUS.isdisjoint(email):
         return False
     
     return True
@@ -152,36 +561,56 @@ def validate_username(username):
         return False
     
     # 只允许字母、数字、下划线和连字符
-    if not re.match(r'^[a-zA-Z0-9_-]+$', username):
+    if not _USERNAME_RE.match(username):
         return False
     
     # 防止注入
-    dangerous_chars = ['<', '>', '"', "'", '&', '\x00', ';', '|', '`']
-    if any(char in username for char in dangerous_chars):
+    if not _USERNAME_DANGEROUS.isdisjoint(username):
         return False
     
     return True
 
 def generate_jwt_token(user_id, email):
     """生成 JWT Token"""
+    now = datetime.utcnow()
     payload = {
         'user_id': user_id,
         'email': email,
-        'exp': datetime.utcnow() + app.config['JWT_ACCESS_TOKEN_EXPIRES'],
-        'iat': datetime.utcnow(),
+        'exp': now + app.config['JWT_ACCESS_TOKEN_EXPIRES'],
+        'iat': now,
         'type': 'access'
     }
     return jwt.encode(payload, app.config['JWT_SECRET_KEY'], algorithm='HS256')
 
+# 已验证 Token 缓存：有效期内重复使用同一 Token 时跳过签名校验和解析
+JWT_CACHE_SIZE = 4096
+_jwt_cache = OrderedDict()  # token -> (payload, exp)
+_jwt_cache_lock = threading.Lock()
+
 def verify_jwt_token(token):
     """验证 JWT Token"""
+    now = time.time()
+    with _jwt_cache_lock:
+        cached = _jwt_cache.get(token)
+        if cached is not None:
+            payload, exp = cached
+            if now < exp:
+                _jwt_cache.move_to_end(token)
+                return payload
+            del _jwt_cache[token]
+    
     try:
         payload = jwt.decode(token, app.config['JWT_SECRET_KEY'], algorithms=['HS256'])
-        return payload
     except jwt.ExpiredSignatureError:
         return None
     except jwt.InvalidTokenError:
         return None
+    
+    with _jwt_cache_lock:
+        _jwt_cache[token] = (payload, payload['exp'])
+        if len(_jwt_cache) > JWT_CACHE_SIZE:
+            _jwt_cache.popitem(last=False)
+    return payload
 
 def require_auth(f):
     """JWT 认证装饰器"""
@@ -234,8 +663,6 @@ def register():
         # if not validate_csrf_token(csrf_token):
         #     return jsonify({"error": "无效的CSRF Token"}), 403
         
-        users = load_users()
-        
         # 验证和清理输入
         email = data.get("email", "").strip().lower()
         password = data.get("password", "")
@@ -263,49 +690,64 @@ def register():
             return jsonify({"error": "密码长度不能超过128位"}), 400
         
         # 密码强度检查（可选）
-        if not re.search(r'[A-Za-z]', password) or not re.search(r'[0-9]', password):
+        if not _PASSWORD_LETTER_RE.search(password) or not _PASSWORD_DIGIT_RE.search(password):
             return jsonify({"error": "密码必须包含字母和数字"}), 400
         
         # 检查邮箱是否已存在（常量时间操作）
-        if email in users:
+        if get_user_by_email(email):
             return jsonify({"error": "该邮箱已被注册"}), 400
         
         # 检查用户名是否已存在
-        existing_usernames = [u.get("username", "").lower() for u in users.values()]
-        if username.lower() in existing_usernames:
+        if username_exists(username):
             return jsonify({"error": "该用户名已被使用"}), 400
         
         # 验证头像数据大小（如果提供）
         avatar = data.get("avatar")
+        avatar_file = None
         if avatar:
             if not isinstance(avatar, str):
                 return jsonify({"error": "头像数据格式无效"}), 400
-            if len(avatar) > 2 * 1024 * 1024:  # 2MB限制
+            if len(avatar) > AVATAR_MAX_ENCODED_LENGTH:
+                return jsonify({"error": "头像数据过大"}), 400
+            avatar_file = decode_avatar(avatar)
+            if not avatar_file:
+                return jsonify({"error": "头像数据格式无效"}), 400
+            if len(avatar_file[0]) > AVATAR_MAX_BYTES:
                 return jsonify({"error": "头像数据过大"}), 400
         
         # 创建新用户
-        user_id = str(len(users) + 1)
+        now_iso = datetime.now().isoformat()
         user = {
-            "id": user_id,
             "username": username,
             "email": email,
             "password": hash_password(password),  # 使用 bcrypt
             "gender": sanitize_input(data.get("gender", ""), max_length=10),
-            "avatar": avatar,
-            "createdAt": datetime.now().isoformat(),
-            "updatedAt": datetime.now().isoformat(),
+            "avatar": None,
+            "createdAt": now_iso,
+            "updatedAt": now_iso,
             "failed_login_attempts": 0,
             "locked_until": None
         }
         
-        users[email] = user
-        save_users(users)
+        # 其余字段都准备好后才写入头像文件，插入失败时删除，不留下孤立文件
+        if avatar_file:
+            user["avatar"] = save_avatar(*avatar_file)
+        try:
+            user_id = create_user(user)
+        except sqlite3.IntegrityError:
+            # 并发注册时由唯一约束兜底
+            delete_avatar(user["avatar"])
+            return jsonify({"error": "该邮箱已被注册"}), 400
+        except Exception:
+            delete_avatar(user["avatar"])
+            raise
+        user["id"] = user_id
         
         # 生成 JWT Token
         token = generate_jwt_token(user_id, email)
         
-        # 返回用户信息（不包含密码）
-        user_response = {k: v for k, v in user.items() if k != "password"}
+        # 返回用户信息（不包含密码等内部字段）
+        user_response = public_user(user)
         return jsonify({
             "success": True, 
             "user": user_response,
@@ -330,8 +772,6 @@ def login():
         if not data:
             return jsonify({"error": "请求数据不能为空"}), 400
         
-        users = load_users()
-        
         email = data.get("email", "").strip().lower()
         password = data.get("password", "")
         
@@ -343,46 +783,43 @@ def login():
             return jsonify({"error": "邮箱或密码错误"}), 401
         
         # 验证用户（常量时间操作，防止用户枚举）
-        user = users.get(email)
+        user = get_user_by_email(email)
         if not user:
             # 即使用户不存在也执行密码验证，防止时序攻击
-            dummy_hash = "$2b$12$" + "x" * 53
-            verify_password(password, dummy_hash)
+            dummy_verify_password(password)
             return jsonify({"error": "邮箱或密码错误"}), 401
         
+        # 本次请求统一使用同一时间点
+        now = datetime.now()
+        
         # 检查账户是否被锁定
         if user.get("locked_until"):
             locked_until = datetime.fromisoformat(user["locked_until"])
-            if datetime.now() < locked_until:
-                remaining = int((locked_until - datetime.now()).total_seconds())
+            if now < locked_until:
+                remaining = int((locked_until - now).total_seconds())
                 return jsonify({
                     "error": f"账户已被锁定，请{remaining}秒后重试"
                 }), 423
         
         # 验证密码（常量时间比较）
         if not verify_password(password, user["password"]):
-            # 增加失败次数
-            user["failed_login_attempts"] = user.get("failed_login_attempts", 0) + 1
-            
-            # 5次失败后锁定账户15分钟
-            if user["failed_login_attempts"] >= 5:
-                user["locked_until"] = (datetime.now() + timedelta(minutes=15)).isoformat()
-                user["failed_login_attempts"] = 0
-            
-            save_users(users)
+            # 增加失败次数，5次失败后锁定账户15分钟
+            record_login_failure(email, now)
             return jsonify({"error": "邮箱或密码错误"}), 401
         
         # 登录成功，重置失败次数
         user["failed_login_attempts"] = 0
         user["locked_until"] = None
-        user["last_login"] = datetime.now().isoformat()
-        save_users(users)
+        user["last_login"] = now.isoformat()
+        # 轮数与当前配置不同的旧哈希（如 12 轮）顺便升级，使其验证耗时与假验证一致
+        new_hash = hash_password(password) if password_needs_rehash(user["password"]) else None
+        record_login_success(email, user["last_login"], new_hash)
         
         # 生成 JWT Token
         token = generate_jwt_token(user["id"], email)
         
-        # 返回用户信息（不包含密码）
-        user_response = {k: v for k, v in user.items() if k != "password"}
+        # 返回用户信息（不包含密码等内部字段）
+        user_response = public_user(user)
         return jsonify({
             "success": True, 
             "user": user_response,
@@ -402,13 +839,12 @@ def get_user(user_id):
         if user_id != g.current_user_id:
             return jsonify({"error": "无权访问"}), 403
         
-        users = load_users()
-        user = next((u for u in users.values() if u["id"] == user_id), None)
+        user = get_user_by_id(user_id)
         
         if not user:
             return jsonify({"error": "用户不存在"}), 404
         
-        user_response = {k: v for k, v in user.items() if k != "password"}
+        user_response = public_user(user)
         return jsonify({"success": True, "user": user_response}), 200
         
     except Exception as e:
@@ -429,13 +865,14 @@ def update_user(user_id):
         if not data:
             return jsonify({"error": "请求数据不能为空"}), 400
         
-        users = load_users()
-        
         # 查找用户
-        user = next((u for u in users.values() if u["id"] == user_id), None)
+        user = get_user_by_id(user_id)
         if not user:
             return jsonify({"error": "用户不存在"}), 404
         
+        # 收集需要更新的列，全部校验通过后一次写入
+        updates = {}
+        
         # 更新用户信息（验证和清理输入）
         if "username" in data:
             username_raw = data["username"].strip()
@@ -443,39 +880,58 @@ def update_user(user_id):
                 return jsonify({"error": "用户名格式无效"}), 400
             username = sanitize_input(username_raw, max_length=20)
             # 检查用户名是否已被其他用户使用
-            existing_usernames = [
-                u.get("username", "").lower() 
-                for u in users.values() 
-                if u["id"] != user_id
-            ]
-            if username.lower() in existing_usernames:
+            if username_exists(username, exclude_id=user_id):
                 return jsonify({"error": "该用户名已被使用"}), 400
-            user["username"] = username
+            updates["username"] = username
         
         if "email" in data:
             new_email = data["email"].strip().lower()
             if not validate_email(new_email):
                 return jsonify({"error": "邮箱格式无效"}), 400
             if new_email != user["email"]:
-                if new_email in users:
+                if get_user_by_email(new_email):
                     return jsonify({"error": "该邮箱已被使用"}), 400
-                del users[user["email"]]
-                user["email"] = new_email
-                users[new_email] = user
+                updates["email"] = new_email
         
         if "gender" in data:
-            user["gender"] = sanitize_input(data["gender"], max_length=10)
+            updates["gender"] = sanitize_input(data["gender"], max_length=10)
         
         if "avatar" in data:
             avatar = data["avatar"]
-            if avatar and len(avatar) > 2 * 1024 * 1024:
-                return jsonify({"error": "头像数据过大"}), 400
-            user["avatar"] = avatar
-        
-        user["updatedAt"] = datetime.now().isoformat()
-        save_users(users)
-        
-        user_response = {k: v for k, v in user.items() if k != "password"}
+            if not avatar:
+                updates["avatar"] = None
+            elif not isinstance(avatar, str):
+                return jsonify({"error": "头像数据格式无效"}), 400
+            elif not is_current_avatar(avatar, user["avatar"]):
+                # 客户端原样传回当前头像地址时视为未修改
+                if len(avatar) > AVATAR_MAX_ENCODED_LENGTH:
+                    return jsonify({"error": "头像数据过大"}), 400
+                decoded = decode_avatar(avatar)
+                if not decoded:
+                    return jsonify({"error": "头像数据格式无效"}), 400
+                avatar_content, avatar_ext = decoded
+                if len(avatar_content) > AVATAR_MAX_BYTES:
+                    return jsonify({"error": "头像数据过大"}), 400
+                updates["avatar"] = save_avatar(avatar_content, avatar_ext)
+        
+        updated_at = datetime.now().isoformat()
+        try:
+            update_user_record(user_id, {**updates, "updated_at": updated_at})
+        except sqlite3.IntegrityError:
+            delete_avatar(updates.get("avatar"))
+            return jsonify({"error": "该邮箱已被使用"}), 400
+        except Exception:
+            delete_avatar(updates.get("avatar"))
+            raise
+        
+        if "avatar" in updates:
+            delete_avatar(user["avatar"])
+        
+        # 更新的列与用户字典同名，直接合并到已读取的数据，无需再按 ID 查询一次
+        user.update(updates)
+        user["updatedAt"] = updated_at
+        
+        user_response = public_user(user)
         return jsonify({"success": True, "user": user_response}), 200
         
     except Exception as e:
@@ -507,10 +963,6 @@ def upload_file():
         if file_ext not in allowed_extensions:
             return jsonify({"error": "不支持的文件类型"}), 400
         
-        # 生成安全的文件名
-        safe_filename = f"{secrets.token_urlsafe(16)}{file_ext}"
-        filepath = os.path.join(UPLOAD_FOLDER, safe_filename)
-        
         # 验证文件大小（10MB限制）
         file.seek(0, os.SEEK_END)
         file_size = file.tell()
@@ -518,11 +970,22 @@ def upload_file():
         if file_size > 10 * 1024 * 1024:
             return jsonify({"error": "文件大小不能超过10MB"}), 400
         
-        file.save(filepath)
+        # 按内容哈希查缓存，命中时无需落盘和提取
+        data = file.read()
+        cache_key = hashlib.blake2b(data, digest_size=16).digest()
+        dominant_color = get_cached_color(cache_key)
         
-        # 提取主色
-        color_thief = ColorThief(filepath)
-        dominant_color = color_thief.get_color(quality=5)
+        if dominant_color is None:
+            # 直接从内存中的文件内容提取主色
+            dominant_color = extract_dominant_color(data)
+            cache_color(cache_key, dominant_color)
+            
+            if app.config['KEEP_UPLOADS']:
+                # 生成安全的文件名
+                safe_filename = f"{secrets.token_urlsafe(16)}{file_ext}"
+                filepath = os.path.join(UPLOAD_FOLDER, safe_filename)
+                with open(filepath, 'wb') as f:
+                    f.write(data)
         
         return jsonify({"dominant_color": dominant_color}), 200
         
@@ -530,6 +993,12 @@ def upload_file():
         print(f"上传错误: {str(e)}")
         return jsonify({"error": "服务器内部错误，请稍后重试"}), 500
 
+@app.route("/avatars/<filename>", methods=["GET"])
+@limiter.exempt
+def get_avatar(filename):
+    """获取头像图片（文件名随机且随头像更换而变化，可长期缓存）"""
+    return send_from_directory(os.path.abspath(AVATAR_FOLDER), filename, max_age=365 * 24 * 3600)
+
 @app.errorhandler(429)
 def ratelimit_handler(e):
     """速率限制错误处理"""
@@ -0,0 +1,29 @@
+"""
+gunicorn 生产环境配置
+
+启动方式（在 backend 目录下）：
+    gunicorn -c gunicorn_conf.py wsgi:app
+"""
+import os
+import secrets
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', (os.cpu_count() or 1) * 2 + 1))
+
+# gevent 协程 worker：单个 worker 内并发处理 I/O 密集请求
+worker_class = 'gevent'
+worker_connections = 1000
+
+# 每个 worker 各自持有主色提取进程池，默认每个 worker 只开 1 个子进程，
+# 否则总进程数为 workers × CPU 核数
+os.environ.setdefault('COLOR_POOL_WORKERS', '1')
+
+# 应用在各 worker 中分别导入，未配置密钥时须在 master 中统一生成，
+# 否则每个 worker 的随机密钥不同，Token 只能在签发它的 worker 上通过验证。
+# 生成的密钥在重启后失效，生产环境应显式设置
+os.environ.setdefault('SECRET_KEY', secrets.token_urlsafe(32))
+os.environ.setdefault('JWT_SECRET_KEY', secrets.token_urlsafe(32))
+
+# 不在 master 中预加载：用户数据在 SQLite 中，预加载省不下什么，
+# 反而会把 master 中已启动的定时器（如限流内存存储的过期清理）带进 worker
+preload_app = False
@@ -0,0 +1,9 @@
+"""
+WSGI 入口（gunicorn + gevent）
+
+必须在导入任何其他模块之前打补丁，否则 app 模块中创建的锁、定时器等不会被 gevent 接管。
+"""
+from gevent import monkey
+monkey.patch_all()
+
+from app import app  # noqa: E402
@@ -1,5 +1,6 @@
 import React, { useState, useRef } from 'react';
 import { useAuth } from '../hooks/useAuth';
+import { validateFile } from '../utils/validators';
 import LoadingSpinner from './LoadingSpinner';
 import styles from './Auth.module.css';
 
@@ -30,13 +31,10 @@ const Profile = () => {
     const handleAvatarChange = (e) => {
         const file = e.target.files[0];
         if (file) {
-            if (file.size > 2 * 1024 * 1024) {
-                setError('头像文件大小不能超过2MB');
-                return;
-            }
-            
-            if (!file.type.startsWith('image/')) {
-                setError('请选择图片文件');
+            // 与后端一致：只接受 PNG/JPEG/GIF/WebP，且不超过 2MB
+            const validation = validateFile(file, ['image/jpeg', 'image/png', 'image/gif', 'image/webp'], 2 * 1024 * 1024);
+            if (!validation.valid) {
+                setError(validation.message);
                 return;
             }
 
@@ -126,7 +124,7 @@ const Profile = () => {
                         <input
                             ref={fileInputRef}
                             type="file"
-                            accept="image/*"
+                            accept="image/png,image/jpeg,image/gif,image/webp"
                             onChange={handleAvatarChange}
                             style={{ display: 'none' }}
                         />
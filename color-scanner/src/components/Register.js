@@ -162,7 +162,7 @@ const Register = ({ onSwitchToLogin }) => {
                         <input
                             ref={fileInputRef}
                             type="file"
-                            accept="image/*"
+                            accept="image/png,image/jpeg,image/gif,image/webp"
                             onChange={handleAvatarChange}
                             style={{ display: 'none' }}
                         />